@@ -1,10 +1,9 @@
-import json
 import os
 import sqlite3
-from datetime import datetime
-from typing import Dict
+import time
 
-from flask import Flask, redirect, render_template, request, url_for, flash
+import orjson
+from flask import Flask, g, redirect, render_template, request, url_for, flash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 
 from db import (
@@ -13,17 +12,17 @@ from db import (
     delete_category,
     delete_transaction,
     fetch_balance,
-    fetch_category_totals,
     fetch_transaction_by_id,
     fetch_transactions_by_month,
     get_all_categories,
-    get_category_label,
     get_user_by_id,
     get_user_by_username,
     init_db,
     insert_transaction,
+    password_needs_rehash,
     reset_all_data,
     update_category,
+    update_password_hash,
     update_transaction,
     verify_password,
 )
@@ -31,6 +30,10 @@ from db import (
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# 本番ではテンプレートを一度だけコンパイルし、リクエストごとの更新チェックをしない
+# （debug=Trueで起動してもこの設定が優先される）
+app.config['TEMPLATES_AUTO_RELOAD'] = os.environ.get('FLASK_ENV') == 'development'
+
 # Flask-Loginの設定
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -56,8 +59,23 @@ def load_user(user_id):
 init_db()
 
 
+def get_request_categories(user_id: int) -> list:
+    """カテゴリ一覧を取得。同じリクエスト内ではgに保存したものを使い回す。"""
+    if 'categories' not in g:
+        g.categories = get_all_categories(user_id)
+    return g.categories
+
+
+def get_valid_category_ids(user_id: int) -> set:
+    """選べるカテゴリIDの集合。同じリクエスト内ではgに保存したものを使い回す。"""
+    if 'valid_category_ids' not in g:
+        g.valid_category_ids = {cat['id'] for cat in get_request_categories(user_id)}
+    return g.valid_category_ids
+
+
 @app.route('/test')
 def test():
+    # Responseは使い回さない（after_requestやセッション保存がリクエストごとにCookieなどを書き込むため）
     return 'Server is working!'
 
 
@@ -74,6 +92,9 @@ def login():
             
             user_data = get_user_by_username(username)
             if user_data and verify_password(user_data['password_hash'], password):
+                # 古い形式のハッシュはログインに成功したときにArgon2idへ移行する
+                if password_needs_rehash(user_data['password_hash']):
+                    update_password_hash(user_data['id'], password)
                 user = User(user_data['id'], user_data['username'])
                 login_user(user)
                 return redirect(url_for('home'))
@@ -168,8 +189,7 @@ def transaction():
                 if not category:
                     error_message = '出金のときはカテゴリを選んでね。'
                 else:
-                    valid_categories = [cat['id'] for cat in get_all_categories(user_id)]
-                    if category not in valid_categories:
+                    if category not in get_valid_category_ids(user_id):
                         error_message = 'カテゴリの選択が正しくありません。'
                     elif amount > balance:
                         error_message = '残金より大きい出金はできません。'
@@ -184,7 +204,7 @@ def transaction():
             )
             return redirect(url_for('home'))
 
-    categories = get_all_categories(user_id)
+    categories = get_request_categories(user_id)
     return render_template(
         'transaction.html',
         balance=balance,
@@ -194,44 +214,55 @@ def transaction():
     )
 
 
+def is_valid_month(value: str) -> bool:
+    """'YYYY-MM'形式の月かどうか。datetimeを作らずに文字列だけで判定する。"""
+    year, sep, month = value.partition('-')
+    return (
+        sep == '-'
+        and len(year) == 4
+        and len(month) == 2
+        and value.isascii()
+        and year.isdigit()
+        and month.isdigit()
+        and year != '0000'
+        and 1 <= int(month) <= 12
+    )
+
+
 @app.route('/history')
 @login_required
 def history():
     user_id = current_user.id
+    today_month = time.strftime('%Y-%m')
+    # 検索はoccurred_monthとの完全一致なので、'YYYY-MM'の形でなければ今月を表示する
     selected_month = request.args.get('month')
-    if not selected_month:
-        selected_month = datetime.today().strftime('%Y-%m')
-    else:
-        try:
-            datetime.fromisoformat(f'{selected_month}-01')
-        except ValueError:
-            selected_month = datetime.today().strftime('%Y-%m')
+    if not selected_month or not is_valid_month(selected_month):
+        selected_month = today_month
 
-    transactions = fetch_transactions_by_month(user_id, selected_month)
+    transactions, category_totals = fetch_transactions_by_month(user_id, selected_month)
     entries = [
         {
             'id': t.id,
-            'display_date': t.occurred_at.strftime('%m/%d'),
+            'display_date': t.display_date,
             'movement': t.movement,
             'amount': t.amount,
-            'category_label': get_category_label(user_id, t.category) if t.category else 'おこづかい',
+            'category_label': t.category_label if t.category else 'おこづかい',
             'memo': t.memo,
             'sign': '+' if t.movement == 'increase' else '-',
         }
         for t in transactions
     ]
 
-    category_totals = fetch_category_totals(user_id, selected_month)
-    categories = get_all_categories(user_id)
-    chart_data: Dict[str, list] = {
+    categories = get_request_categories(user_id)
+    chart_json = orjson.dumps({
         'labels': [cat['label'] for cat in categories],
         'values': [category_totals.get(cat['id'], 0) for cat in categories],
-    }
+    }).decode()
 
     return render_template(
         'history.html',
         entries=entries,
-        chart_data=json.dumps(chart_data, ensure_ascii=False),
+        chart_data=chart_json,
         selected_month=selected_month,
     )
 
@@ -285,14 +316,13 @@ def edit_transaction(transaction_id: int):
                 if not category:
                     error_message = '出金のときはカテゴリを選んでね。'
                 else:
-                    valid_categories = [cat['id'] for cat in get_all_categories(user_id)]
-                    if category not in valid_categories:
+                    if category not in get_valid_category_ids(user_id):
                         error_message = 'カテゴリの選択が正しくありません。'
                     elif amount > balance_without_this:
                         error_message = '残金より大きい出金はできません。'
 
         if error_message is None:
-            update_transaction(
+            updated = update_transaction(
                 user_id,
                 transaction_id,
                 movement=movement,
@@ -300,9 +330,11 @@ def edit_transaction(transaction_id: int):
                 category=category if movement == 'decrease' else None,
                 memo=memo,
             )
-            return redirect(url_for('history', month=transaction.occurred_at.strftime('%Y-%m')))
+            if updated is None:
+                return redirect(url_for('history'))
+            return redirect(url_for('history', month=updated.occurred_month))
 
-    categories = get_all_categories(user_id)
+    categories = get_request_categories(user_id)
     return render_template(
         'edit_transaction.html',
         transaction_id=transaction_id,
@@ -320,7 +352,7 @@ def delete_transaction_route(transaction_id: int):
     transaction = fetch_transaction_by_id(user_id, transaction_id)
     if transaction is not None:
         delete_transaction(user_id, transaction_id)
-        return redirect(url_for('history', month=transaction.occurred_at.strftime('%Y-%m')))
+        return redirect(url_for('history', month=transaction.occurred_month))
     return redirect(url_for('history'))
 
 
@@ -358,7 +390,7 @@ def settings():
                 delete_category(user_id, category_id)
             return redirect(url_for('settings'))
     
-    categories = get_all_categories(user_id)
+    categories = get_request_categories(user_id)
     return render_template('settings.html', categories=categories)
 
 
@@ -1,11 +1,17 @@
 from __future__ import annotations
 
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime
 from pathlib import Path
-from typing import List
-from werkzeug.security import generate_password_hash, check_password_hash
+from typing import Iterable, Iterator, List
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
 
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / 'money_pocket.db'
@@ -14,6 +20,10 @@ DB_PATH = BASE_DIR / 'money_pocket.db'
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 
+# パスワードはArgon2idでハッシュ化する（OWASP推奨値: メモリ46MiB, 反復1回, 並列度1）
+_password_hasher = PasswordHasher(memory_cost=47104, time_cost=1, parallelism=1)
+
+
 DEFAULT_CATEGORIES = [
     ('food', '食べ物'),
     ('fun', '遊び'),
@@ -23,27 +33,55 @@ DEFAULT_CATEGORIES = [
 ]
 
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     id: int
-    occurred_at: datetime
+    occurred_at: int  # UNIX秒。表示用の文字列は必要になったときに作る
     movement: str
     amount: int
     category: str | None
     memo: str | None
+    category_label: str | None = None
+    occurred_month: str | None = None
+
+    @property
+    def display_date(self) -> str:
+        """一覧に表示する日付（'MM/DD'）"""
+        return time.strftime('%m/%d', time.localtime(self.occurred_at))
+
+
+# 接続プールの大きさ。1プロセスで同時に使う接続はこの本数まで
+POOL_SIZE = 4
+
+_pool: queue.Queue[sqlite3.Connection] | None = None
+_pool_lock = threading.Lock()
+_wal_enabled = False
 
 
 def get_connection() -> sqlite3.Connection:
-    """データベース接続を取得。確実に永続化されるように設定。"""
+    """新しいデータベース接続を作成。確実に永続化されるように設定。"""
     # データベースファイルの親ディレクトリが存在することを確認
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     
-    # SQLite接続を作成（Flaskアプリではcheck_same_thread=Falseが必要）
-    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    # SQLite接続を作成（プールの接続は別スレッドでも使うのでcheck_same_thread=Falseが必要）
+    # プールの接続は使い回すので、準備済みステートメントのキャッシュも大きめに取る
+    # isolation_level=Noneで自動コミットにし、複数の文をまとめる書き込みだけtx()で囲む
+    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, cached_statements=256, isolation_level=None)
     conn.row_factory = sqlite3.Row
     
     # WALモードを有効にして、同時アクセスを改善
-    conn.execute('PRAGMA journal_mode=WAL')
+    # journal_modeはファイルに保存されるので、プロセスごとに1回だけ設定する
+    global _wal_enabled
+    if not _wal_enabled:
+        conn.execute('PRAGMA journal_mode=WAL')
+        _wal_enabled = True
+
+    # WALモードではNORMALでも安全。fsyncはチェックポイント時だけになる
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA cache_spill=OFF')
     
     # 外部キー制約を有効化
     conn.execute('PRAGMA foreign_keys=ON')
@@ -51,207 +89,330 @@ def get_connection() -> sqlite3.Connection:
     return conn
 
 
-def init_db() -> None:
-    """データベースを初期化し、テーブルを作成する。確実に永続化される。"""
-    conn = get_connection()
+def _get_pool() -> queue.Queue[sqlite3.Connection]:
+    """接続プールを取得。最初に呼ばれたときにPOOL_SIZE本の接続を開いておく。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=POOL_SIZE)
+                for _ in range(POOL_SIZE):
+                    pool.put(get_connection())
+                _pool = pool
+    return _pool
+
+
+@contextmanager
+def acquire() -> Iterator[sqlite3.Connection]:
+    """プールから接続を借りる。全て使用中のときは返却されるまで待つ。"""
+    pool = _get_pool()
+    conn = pool.get()
     try:
-        # ユーザーテーブルの作成
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            );
-            """
-        )
-        
-        # トランザクションテーブルの作成（user_idカラム付き）
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                occurred_at TEXT NOT NULL,
-                movement TEXT NOT NULL CHECK(movement IN ('increase', 'decrease')),
-                amount INTEGER NOT NULL CHECK(amount > 0),
-                category TEXT,
-                memo TEXT
-            );
-            """
-        )
-        
-        # 既存のtransactionsテーブルにuser_idカラムがない場合は追加
-        try:
-            conn.execute("ALTER TABLE transactions ADD COLUMN user_id INTEGER")
-        except sqlite3.OperationalError:
-            pass  # カラムが既に存在する場合は無視
-        
-        # 既存のcategoriesテーブルにuser_idカラムがない場合は追加
-        try:
-            # まず、既存のテーブルにuser_idカラムがあるか確認
-            cursor = conn.execute("PRAGMA table_info(categories)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'user_id' not in columns:
-                conn.execute("ALTER TABLE categories ADD COLUMN user_id INTEGER")
-                # 既存のカテゴリのuser_idをNULLに設定（全員共通）
-                conn.execute("UPDATE categories SET user_id = NULL")
-        except sqlite3.OperationalError:
-            pass  # エラーが発生した場合は無視
-        
-        # カテゴリテーブルの作成（user_idカラム付き）
-        # 既存のテーブルがある場合は、CREATE TABLE IF NOT EXISTSでスキップされる
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS categories (
-                id TEXT NOT NULL,
-                user_id INTEGER,
-                label TEXT NOT NULL,
-                display_order INTEGER NOT NULL DEFAULT 0
-            );
-            """
-        )
-        
-        conn.commit()
-        
-        # デフォルトカテゴリを初期化（user_id = NULLで全員共通）
-        existing = conn.execute("SELECT COUNT(*) FROM categories WHERE user_id IS NULL").fetchone()[0]
-        if existing == 0:
-            for idx, (cat_id, label) in enumerate(DEFAULT_CATEGORIES):
-                conn.execute(
-                    "INSERT INTO categories (id, user_id, label, display_order) VALUES (?, ?, ?, ?)",
-                    (cat_id, None, label, idx),
-                )
-            # 明示的にコミットして永続化を保証
-            conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
+        yield conn
     finally:
-        conn.close()
+        # 途中のトランザクションを次の利用者に持ち越さない
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
 
 
-def insert_transaction(*, user_id: int, movement: str, amount: int, category: str | None, memo: str | None) -> None:
-    """トランザクションを挿入し、確実に永続化する。"""
-    conn = get_connection()
+@contextmanager
+def tx(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """BEGIN IMMEDIATEからCOMMITまでを1つのトランザクションにする。例外が起きたらROLLBACKする。"""
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        conn.execute(
-            """
-            INSERT INTO transactions (user_id, occurred_at, movement, amount, category, memo)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, datetime.now().isoformat(timespec='seconds'), movement, amount, category, memo),
-        )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
+        yield conn
+    except BaseException:
+        # SQLITE_FULLなどではSQLiteが自分でロールバック済みなので、残っているときだけ戻す
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
         raise
-    finally:
-        conn.close()
+    conn.execute('COMMIT')
 
 
-def fetch_balance(user_id: int) -> int:
-    with get_connection() as conn:
+# スキーマを変えたら上げる。init_dbはPRAGMA user_versionがこれ未満のときだけ作成・移行を行う
+SCHEMA_VERSION = 1
+
+
+# occurred_atはUNIX秒（INTEGER）で保存する
+# occurred_monthは月ごとの検索用に、記録した時点のローカル時刻で'YYYY-MM'を入れておく
+# （localtimeを使う式は生成カラムにできないので、挿入時にアプリ側で設定する）
+_CREATE_TRANSACTIONS_SQL = """
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    occurred_at INTEGER NOT NULL,
+    occurred_month TEXT,
+    movement TEXT NOT NULL CHECK(movement IN ('increase', 'decrease')),
+    amount INTEGER NOT NULL CHECK(amount > 0),
+    category TEXT,
+    memo TEXT
+)
+"""
+
+
+def init_db() -> None:
+    """データベースを初期化し、テーブルを作成する。確実に永続化される。
+
+    スキーマのバージョンはPRAGMA user_versionに記録しておき、
+    最新ならバージョンを1回読むだけで戻る。バージョンが0のデータベースは、
+    新しく作ったものか、occurred_atをISO文字列で持っていた以前のスキーマのどちらか。
+    """
+    with acquire() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # 作成・移行・インデックス・初期データまでを1つのトランザクションで行う
+        with tx(conn):
+            # 書き込みロックを待つ間に、別のプロセスが移行を終えていることがある
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+
+            # ユーザーテーブルの作成
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+                """
+            )
+
+            # カテゴリテーブルの作成（user_idカラム付き）
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS categories (
+                    id TEXT NOT NULL,
+                    user_id INTEGER,
+                    label TEXT NOT NULL,
+                    display_order INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+
+            # トランザクションテーブルの作成（user_idカラム付き）
+            has_transactions = conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'transactions'"
+            ).fetchone()[0] > 0
+            if has_transactions:
+                # occurred_atがISO文字列（TEXT）の以前のテーブルは、UNIX秒（INTEGER）のテーブルに作り直す
+                # SQLiteはカラムの型を変更できないので、名前を変えて新しいテーブルへコピーする
+                conn.execute("ALTER TABLE transactions RENAME TO transactions_old")
+            conn.execute(_CREATE_TRANSACTIONS_SQL)
+            if has_transactions:
+                conn.execute(
+                    """
+                    INSERT INTO transactions (id, user_id, occurred_at, occurred_month, movement, amount, category, memo)
+                    SELECT
+                        id, user_id, CAST(strftime('%s', occurred_at, 'utc') AS INTEGER), substr(occurred_at, 1, 7),
+                        movement, amount, category, memo
+                    FROM transactions_old
+                    """
+                )
+                conn.execute("DROP TABLE transactions_old")
+
+            # 残高テーブル。既存の取引から残高を計算して埋め、以降はトリガーで更新する
+            conn.execute(
+                """
+                CREATE TABLE balances (
+                    user_id INTEGER PRIMARY KEY,
+                    balance INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO balances (user_id, balance)
+                SELECT user_id, SUM(CASE WHEN movement = 'increase' THEN amount ELSE -amount END)
+                FROM transactions
+                WHERE user_id IS NOT NULL
+                GROUP BY user_id
+                """
+            )
+
+            # 取引の挿入・更新・削除と同じ文の中で残高を足し引きする
+            # （バックフィルのあとに作るので、既存の取引が二重に数えられることはない）
+            conn.execute(
+                """
+                CREATE TRIGGER trg_tx_balance_insert AFTER INSERT ON transactions
+                WHEN NEW.user_id IS NOT NULL
+                BEGIN
+                    INSERT INTO balances (user_id, balance)
+                    VALUES (NEW.user_id, CASE WHEN NEW.movement = 'increase' THEN NEW.amount ELSE -NEW.amount END)
+                    ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance;
+                END
+                """
+            )
+            conn.execute(
+                """
+                CREATE TRIGGER trg_tx_balance_update AFTER UPDATE OF user_id, movement, amount ON transactions
+                BEGIN
+                    UPDATE balances
+                    SET balance = balance - CASE WHEN OLD.movement = 'increase' THEN OLD.amount ELSE -OLD.amount END
+                    WHERE user_id = OLD.user_id;
+                    INSERT INTO balances (user_id, balance)
+                    SELECT NEW.user_id, CASE WHEN NEW.movement = 'increase' THEN NEW.amount ELSE -NEW.amount END
+                    WHERE NEW.user_id IS NOT NULL
+                    ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance;
+                END
+                """
+            )
+            conn.execute(
+                """
+                CREATE TRIGGER trg_tx_balance_delete AFTER DELETE ON transactions
+                WHEN OLD.user_id IS NOT NULL
+                BEGIN
+                    UPDATE balances
+                    SET balance = balance - CASE WHEN OLD.movement = 'increase' THEN OLD.amount ELSE -OLD.amount END
+                    WHERE user_id = OLD.user_id;
+                END
+                """
+            )
+
+            # 月ごとの一覧、カテゴリの付け替え、カテゴリ一覧・カテゴリ名のためのインデックス
+            # 月ごとの一覧で使うカラムを全部含めて、表を読まずにインデックスだけで返せるようにする
+            # （同じ秒の取引は登録順に並ぶよう、occurred_atの次にidを置く）
+            conn.execute(
+                """
+                CREATE INDEX idx_tx_user_month_cov
+                ON transactions(user_id, occurred_month, occurred_at, id, movement, amount, category, memo)
+                """
+            )
+            conn.execute("CREATE INDEX idx_tx_user_cat ON transactions(user_id, category)")
+            conn.execute("CREATE INDEX idx_cat_user ON categories(user_id, display_order, id)")
+            # 月ごとの一覧でカテゴリ名を引くサブクエリ用（idで探してlabelまでインデックスから読む）
+            conn.execute("CREATE INDEX idx_cat_id ON categories(id, user_id, label)")
+            # インデックスを作ったので、統計情報を集めてプランナーに使わせる
+            conn.execute('ANALYZE')
+
+            # デフォルトカテゴリを初期化（user_id = NULLで全員共通）
+            existing = conn.execute("SELECT COUNT(*) FROM categories WHERE user_id IS NULL").fetchone()[0]
+            if existing == 0:
+                conn.executemany(
+                    "INSERT INTO categories (id, user_id, label, display_order) VALUES (?, ?, ?, ?)",
+                    [(cat_id, None, label, idx) for idx, (cat_id, label) in enumerate(DEFAULT_CATEGORIES)],
+                )
+
+            # PRAGMAはパラメータを使えないので、定数を埋め込む
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    _invalidate_categories()
+
+
+def _transaction_from_row(row: sqlite3.Row) -> Transaction:
+    """id, occurred_at, occurred_month, movement, amount, category, memo を持つ行からTransactionを作る"""
+    return Transaction(
+        id=row['id'],
+        occurred_at=row['occurred_at'],
+        movement=row['movement'],
+        amount=row['amount'],
+        category=row['category'],
+        memo=row['memo'],
+        occurred_month=row['occurred_month'],
+    )
+
+
+def insert_transaction(*, user_id: int, movement: str, amount: int, category: str | None, memo: str | None) -> Transaction:
+    """トランザクションを挿入し、確実に永続化する。挿入した行をRETURNINGでそのまま返す。"""
+    occurred_at = int(time.time())
+    occurred_month = time.strftime('%Y-%m', time.localtime(occurred_at))
+    # 残高はトリガーが同じ文の中で更新するので、1文だけで済む
+    with acquire() as conn:
         row = conn.execute(
             """
-            SELECT
-                COALESCE(SUM(CASE WHEN movement = 'increase' THEN amount ELSE -amount END), 0) AS balance
-            FROM transactions
-            WHERE user_id = ?
+            INSERT INTO transactions (user_id, occurred_at, occurred_month, movement, amount, category, memo)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id, occurred_at, occurred_month, movement, amount, category, memo
             """,
-            (user_id,),
+            (user_id, occurred_at, occurred_month, movement, amount, category, memo),
         ).fetchone()
-        return row['balance'] if row else 0
-
+    return _transaction_from_row(row)
 
-def fetch_transactions_by_month(user_id: int, month: str) -> List[Transaction]:
-    start = datetime.fromisoformat(f"{month}-01")
-    if start.month == 12:
-        end = start.replace(year=start.year + 1, month=1)
-    else:
-        end = start.replace(month=start.month + 1)
 
-    with get_connection() as conn:
-        rows = conn.execute(
+def insert_transactions_bulk(
+    user_id: int,
+    rows: Iterable[tuple[int, str, int, str | None, str | None]],
+) -> None:
+    """複数のトランザクションをまとめて挿入し、確実に永続化する。
+
+    rowsは (occurred_at（UNIX秒）, movement, amount, category, memo) の並び。
+    全件を1つのトランザクションで挿入するので、コミット（fsync）は1回で済む。
+    """
+    params = [
+        (user_id, occurred_at, time.strftime('%Y-%m', time.localtime(occurred_at)), movement, amount, category, memo)
+        for occurred_at, movement, amount, category, memo in rows
+    ]
+    if not params:
+        return
+    with acquire() as conn, tx(conn):
+        conn.executemany(
             """
-            SELECT id, occurred_at, movement, amount, category, memo
-            FROM transactions
-            WHERE user_id = ? AND occurred_at >= ? AND occurred_at < ?
-            ORDER BY occurred_at ASC
+            INSERT INTO transactions (user_id, occurred_at, occurred_month, movement, amount, category, memo)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (user_id, start.isoformat(timespec='seconds'), end.isoformat(timespec='seconds')),
-        ).fetchall()
-
-    transactions: List[Transaction] = []
-    for row in rows:
-        transactions.append(
-            Transaction(
-                id=row['id'],
-                occurred_at=datetime.fromisoformat(row['occurred_at']),
-                movement=row['movement'],
-                amount=row['amount'],
-                category=row['category'],
-                memo=row['memo'],
-            )
+            params,
         )
-    return transactions
 
 
-def fetch_category_totals(user_id: int, month: str) -> dict[str, int]:
-    # 全てのカテゴリを取得（全員共通 + ユーザー固有）
-    categories = get_all_categories(user_id)
-    totals = {cat['id']: 0 for cat in categories}
+def fetch_balance(user_id: int) -> int:
+    with acquire() as conn:
+        row = conn.execute("SELECT balance FROM balances WHERE user_id = ?", (user_id,)).fetchone()
+        return row['balance'] if row else 0
 
-    start = datetime.fromisoformat(f"{month}-01")
-    if start.month == 12:
-        end = start.replace(year=start.year + 1, month=1)
-    else:
-        end = start.replace(month=start.month + 1)
 
-    with get_connection() as conn:
-        rows = conn.execute(
+def iter_transactions_by_month(user_id: int, month: str) -> Iterator[Transaction]:
+    """月（'YYYY-MM'）の取引を1件ずつ返す。最後まで読むか閉じるまで接続を借りたままになる。"""
+    with acquire() as conn:
+        # 行数が多くなる読み出しなので、sqlite3.Rowではなくタプルで受け取って位置で展開する
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(
             """
-            SELECT category, SUM(amount) AS total
-            FROM transactions
-            WHERE user_id = ? AND movement = 'decrease'
-              AND occurred_at >= ? AND occurred_at < ?
-            GROUP BY category
+            SELECT
+                t.id, t.occurred_at, t.movement, t.amount, t.category, t.memo, t.occurred_month,
+                (
+                    SELECT c.label FROM categories c
+                    WHERE c.id = t.category AND (c.user_id IS NULL OR c.user_id = t.user_id)
+                    LIMIT 1
+                ) AS category_label
+            FROM transactions t
+            WHERE t.user_id = ? AND t.occurred_month = ?
+            ORDER BY t.occurred_at ASC, t.id ASC
             """,
-            (user_id, start.isoformat(timespec='seconds'), end.isoformat(timespec='seconds')),
-        ).fetchall()
+            (user_id, month),
+        )
+        for tid, occurred_at, movement, amount, category, memo, occurred_month, category_label in cursor:
+            yield Transaction(
+                tid, occurred_at, movement, amount, category, memo,
+                category_label=category_label, occurred_month=occurred_month,
+            )
+
 
-    for row in rows:
-        key = row['category'] or 'other'
-        if key not in totals:
-            totals[key] = 0
-        totals[key] = row['total']
-    return totals
+def fetch_transactions_by_month(user_id: int, month: str) -> tuple[List[Transaction], dict[str, int]]:
+    """月（'YYYY-MM'）の取引一覧と、同じ行から集計したカテゴリ別の出金合計を返す。"""
+    transactions: List[Transaction] = []
+    totals: dict[str, int] = {}
+    for t in iter_transactions_by_month(user_id, month):
+        if t.movement == 'decrease':
+            key = t.category or 'other'
+            totals[key] = totals.get(key, 0) + t.amount
+        transactions.append(t)
+    return transactions, totals
 
 
 def fetch_transaction_by_id(user_id: int, transaction_id: int) -> Transaction | None:
-    with get_connection() as conn:
+    with acquire() as conn:
         row = conn.execute(
             """
-            SELECT id, occurred_at, movement, amount, category, memo
+            SELECT id, occurred_at, occurred_month, movement, amount, category, memo
             FROM transactions
             WHERE id = ? AND user_id = ?
             """,
             (transaction_id, user_id),
         ).fetchone()
 
-        if row is None:
-            return None
-
-        return Transaction(
-            id=row['id'],
-            occurred_at=datetime.fromisoformat(row['occurred_at']),
-            movement=row['movement'],
-            amount=row['amount'],
-            category=row['category'],
-            memo=row['memo'],
-        )
+    return _transaction_from_row(row) if row is not None else None
 
 
 def update_transaction(
@@ -262,31 +423,26 @@ def update_transaction(
     amount: int,
     category: str | None,
     memo: str | None,
-) -> None:
-    """トランザクションを更新し、確実に永続化する。"""
-    conn = get_connection()
-    try:
-        conn.execute(
+) -> Transaction | None:
+    """トランザクションを更新し、確実に永続化する。更新後の行を返す（見つからなければNone）。"""
+    # 残高の差し引きはトリガーが行う
+    with acquire() as conn:
+        row = conn.execute(
             """
             UPDATE transactions
             SET movement = ?, amount = ?, category = ?, memo = ?
             WHERE id = ? AND user_id = ?
+            RETURNING id, occurred_at, occurred_month, movement, amount, category, memo
             """,
             (movement, amount, category, memo, transaction_id, user_id),
-        )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+        ).fetchone()
+    return _transaction_from_row(row) if row is not None else None
 
 
 def delete_transaction(user_id: int, transaction_id: int) -> None:
     """トランザクションを削除し、確実に永続化する。"""
-    conn = get_connection()
-    try:
+    # 残高からの差し引きはトリガーが行う
+    with acquire() as conn:
         conn.execute(
             """
             DELETE FROM transactions
@@ -294,29 +450,40 @@ def delete_transaction(user_id: int, transaction_id: int) -> None:
             """,
             (transaction_id, user_id),
         )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
 
 
-def get_category_label(user_id: int, category_id: str) -> str | None:
-    """全員共通のカテゴリ（user_id IS NULL）とユーザー固有のカテゴリから取得"""
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT label FROM categories WHERE id = ? AND (user_id IS NULL OR user_id = ?)",
-            (category_id, user_id),
-        ).fetchone()
-        return row['label'] if row else None
+# カテゴリ一覧のキャッシュ（ユーザーID → カテゴリ一覧）
+# カテゴリはめったに変わらないので、変更したときだけ捨てて読み直す
+_categories_cache: dict[int, List[sqlite3.Row]] = {}
+_categories_cache_lock = threading.Lock()
+# キャッシュを捨てるたびに増やす。読み込み中に変更があった結果をキャッシュしないために使う
+_categories_generation = 0
 
 
-def get_all_categories(user_id: int) -> List[dict[str, str | int | None]]:
-    """全員共通のカテゴリ（user_id IS NULL）とユーザー固有のカテゴリを取得"""
-    with get_connection() as conn:
-        rows = conn.execute(
+def _invalidate_categories(user_id: int | None = None) -> None:
+    """カテゴリ一覧のキャッシュを捨てる。user_idがNoneなら全員分を捨てる。"""
+    global _categories_generation
+    with _categories_cache_lock:
+        _categories_generation += 1
+        if user_id is None:
+            _categories_cache.clear()
+        else:
+            _categories_cache.pop(user_id, None)
+
+
+def get_all_categories(user_id: int) -> List[sqlite3.Row]:
+    """全員共通のカテゴリ（user_id IS NULL）とユーザー固有のカテゴリを取得。
+
+    行はsqlite3.Rowのまま返す（row['id']のように読める。dictが必要ならdict(row)で変換する）。
+    結果はキャッシュしたものを共有して返すので、呼び出し元で変更しないこと。
+    """
+    cached = _categories_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    generation = _categories_generation
+    with acquire() as conn:
+        categories = conn.execute(
             """
             SELECT id, user_id, label, display_order FROM categories
             WHERE user_id IS NULL OR user_id = ?
@@ -324,13 +491,17 @@ def get_all_categories(user_id: int) -> List[dict[str, str | int | None]]:
             """,
             (user_id,),
         ).fetchall()
-        return [{'id': row['id'], 'user_id': row['user_id'], 'label': row['label'], 'display_order': row['display_order']} for row in rows]
+
+    with _categories_cache_lock:
+        if generation == _categories_generation:
+            _categories_cache[user_id] = categories
+    return categories
 
 
 def add_category(user_id: int, category_id: str, label: str) -> None:
     """カテゴリを追加し、確実に永続化する。"""
-    conn = get_connection()
-    try:
+    with acquire() as conn, tx(conn):
+        # 最大の表示順を読んでから挿入する（tx()が最初に書き込みロックを取っている）
         max_order = conn.execute(
             "SELECT COALESCE(MAX(display_order), -1) FROM categories WHERE user_id = ? OR user_id IS NULL",
             (user_id,),
@@ -339,37 +510,24 @@ def add_category(user_id: int, category_id: str, label: str) -> None:
             "INSERT INTO categories (id, user_id, label, display_order) VALUES (?, ?, ?, ?)",
             (category_id, user_id, label, max_order + 1),
         )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    _invalidate_categories(user_id)
 
 
 def update_category(user_id: int, category_id: str, new_label: str) -> None:
     """カテゴリを更新し、確実に永続化する。"""
-    conn = get_connection()
-    try:
+    with acquire() as conn:
         # 全員共通のカテゴリ（user_id IS NULL）は更新できない
         conn.execute(
             "UPDATE categories SET label = ? WHERE id = ? AND user_id = ?",
             (new_label, category_id, user_id),
         )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    _invalidate_categories(user_id)
 
 
 def delete_category(user_id: int, category_id: str) -> None:
     """カテゴリを削除し、確実に永続化する。"""
-    conn = get_connection()
-    try:
+    with acquire() as conn, tx(conn):
+        # 2つの変更を1つのトランザクションにまとめ、コミット（fsync）も1回にする
         # 全員共通のカテゴリ（user_id IS NULL）は削除できない
         # このカテゴリを使用しているトランザクションを「その他」に変更
         conn.execute(
@@ -377,57 +535,37 @@ def delete_category(user_id: int, category_id: str) -> None:
             (user_id, category_id),
         )
         conn.execute("DELETE FROM categories WHERE id = ? AND user_id = ?", (category_id, user_id))
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    _invalidate_categories(user_id)
 
 
 def reset_all_data(user_id: int) -> None:
     """特定のユーザーのデータをリセット（トランザクションとユーザー固有のカテゴリ）し、確実に永続化する。"""
-    conn = get_connection()
-    try:
+    with acquire() as conn, tx(conn):
+        # 3つの削除を1つのトランザクションにまとめ、コミット（fsync）も1回にする
         conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM balances WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM categories WHERE user_id = ?", (user_id,))
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    _invalidate_categories(user_id)
 
 
 # ユーザー認証関連の関数
 def create_user(username: str, password: str) -> int | None:
     """ユーザーを作成し、ユーザーIDを返す。既に存在する場合はNoneを返す。"""
-    conn = get_connection()
-    try:
-        password_hash = generate_password_hash(password)
-        cursor = conn.execute(
-            "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
-            (username, password_hash, datetime.now().isoformat(timespec='seconds')),
-        )
-        # 明示的にコミットして永続化を保証
-        conn.commit()
-        user_id = cursor.lastrowid
-        return user_id
-    except sqlite3.IntegrityError:
-        conn.rollback()
-        return None  # ユーザー名が既に存在する
-    except Exception:
-        conn.rollback()
-        raise  # その他のエラーは再発生
-    finally:
-        conn.close()
+    password_hash = _password_hasher.hash(password)
+    with acquire() as conn:
+        try:
+            cursor = conn.execute(
+                "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                (username, password_hash, time.strftime('%Y-%m-%dT%H:%M:%S')),
+            )
+        except sqlite3.IntegrityError:
+            return None  # ユーザー名が既に存在する
+        return cursor.lastrowid
 
 
 def get_user_by_username(username: str) -> dict | None:
     """ユーザー名でユーザーを取得"""
-    with get_connection() as conn:
+    with acquire() as conn:
         row = conn.execute(
             "SELECT id, username, password_hash FROM users WHERE username = ?",
             (username,),
@@ -439,7 +577,7 @@ def get_user_by_username(username: str) -> dict | None:
 
 def get_user_by_id(user_id: int) -> dict | None:
     """ユーザーIDでユーザーを取得"""
-    with get_connection() as conn:
+    with acquire() as conn:
         row = conn.execute(
             "SELECT id, username FROM users WHERE id = ?",
             (user_id,),
@@ -450,5 +588,28 @@ def get_user_by_id(user_id: int) -> dict | None:
 
 
 def verify_password(password_hash: str, password: str) -> bool:
-    """パスワードを検証"""
-    return check_password_hash(password_hash, password)
+    """パスワードを検証。Argon2以前のwerkzeug形式のハッシュも受け付ける。"""
+    if not password_hash.startswith(('$argon2id$', '$argon2i$')):
+        return check_password_hash(password_hash, password)
+    try:
+        return _password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """古い形式やパラメータのハッシュで、作り直しが必要かどうか"""
+    if not password_hash.startswith('$argon2id$'):
+        return True
+    return _password_hasher.check_needs_rehash(password_hash)
+
+
+def update_password_hash(user_id: int, password: str) -> None:
+    """パスワードを現在の設定でハッシュ化し直し、確実に永続化する。"""
+    # ハッシュ化は重いので、接続を借りる前に済ませておく
+    password_hash = _password_hasher.hash(password)
+    with acquire() as conn:
+        conn.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ?",
+            (password_hash, user_id),
+        )